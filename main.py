@@ -1,13 +1,18 @@
-from fastapi import FastAPI, HTTPException, Query, Depends
-from sqlalchemy import create_engine, Column, Text, Float
+from contextlib import asynccontextmanager
+
+import orjson
+import redis.asyncio as aioredis
+from fastapi import FastAPI, HTTPException, Query, Depends, Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from sqlalchemy import select, text, lambda_stmt, tuple_, Column, Text, Float, Index
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
-from sqlalchemy.sql import func, and_
-from sqlalchemy import create_engine, Column, Text, Float, BigInteger, TIMESTAMP
-from pydantic import BaseModel
-import math
-from typing import Optional, List
-from datetime import datetime
+from sqlalchemy.sql import func
+from sqlalchemy import Column, Text, Float, BigInteger, TIMESTAMP, Date
+from pydantic import BaseModel, ConfigDict
+from typing import Optional, List, Dict
+from datetime import datetime, date
 
 # Database configuration
 from dotenv import load_dotenv
@@ -22,13 +27,99 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL is not set in the environment or .env file")
 
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# The queries are I/O-bound on Postgres round-trips, so run them through the
+# asyncpg driver to keep the event loop free while they are in flight
+if DATABASE_URL.startswith("postgresql://"):
+    DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+POOL_SIZE = 10
+
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=POOL_SIZE,
+    max_overflow=20,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    query_cache_size=1200,
+)
+SessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+# Optional Redis cache for /weather; the underlying forecasts refresh daily,
+# so a short TTL collapses DB load to one query per filter combination
+REDIS_URL = os.getenv("REDIS_URL")
+WEATHER_CACHE_TTL = int(os.getenv("WEATHER_CACHE_TTL", "3600"))
+redis_client = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+cache_stats = {"hit": 0, "miss": 0}
+
+async def invalidate_weather_cache():
+    if redis_client is None:
+        return
+    async for key in redis_client.scan_iter(match="weather:*"):
+        await redis_client.delete(key)
 
 Base = declarative_base()
 
+# Separate registry for models mapped onto views, so create_all does not try
+# to create them as plain tables
+ViewBase = declarative_base()
+
+# Pre-joined view of the three weather tables so /weather is a single indexed
+# scan instead of a 3-way outer join per request. The unique index is required
+# for REFRESH MATERIALIZED VIEW CONCURRENTLY. Keep the definition in sync with
+# the copy in migrations/001_weather_forecast_date_to_date.sql.
+WEATHER_DAILY_DDL = [
+    """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS weather_daily AS
+    SELECT rh.forecast_date,
+           rh.day_name,
+           rh.municipality_code,
+           rh.municipality_name,
+           rh.value AS relative_humidity,
+           t.value AS temperature_max,
+           r.value AS rainfall,
+           CASE WHEN rh.value IS NOT NULL AND t.value BETWEEN -50 AND 80
+                THEN t.value + 0.5555 * (6.11 * exp(5417.7530 * (1/273.15 - 1/(273.15 + t.value))) - 10)
+           END AS heat_index
+    FROM rh_daily_avg_region rh
+    LEFT JOIN tmax_daily_tmax_region t USING (forecast_date, day_name, municipality_code)
+    LEFT JOIN rainfall_daily_weighted_average r USING (forecast_date, day_name, municipality_code)
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_weather_daily_date_code ON weather_daily (forecast_date, municipality_code)",
+    "CREATE INDEX IF NOT EXISTS ix_weather_daily_municipality_name ON weather_daily (municipality_name)",
+]
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Only dev bootstraps the base tables; on deployed databases they already
+    # exist and are altered via the SQL in migrations/, so re-running
+    # create_all per worker would only add catalog round-trips
+    if os.getenv("APP_ENV") == "dev":
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    # The view DDL is IF NOT EXISTS, so run it everywhere: production needs
+    # weather_daily too, and on an up-to-date database this is a no-op
+    async with engine.begin() as conn:
+        for ddl in WEATHER_DAILY_DDL:
+            await conn.execute(text(ddl))
+
+    # Warm the whole pool so the first POOL_SIZE requests do not pay
+    # connect() latency
+    conns = [await engine.connect() for _ in range(POOL_SIZE)]
+    for conn in conns:
+        await conn.close()
+
+    yield
+    if redis_client is not None:
+        await redis_client.aclose()
+    await engine.dispose()
+
 # Create FastAPI app
-app = FastAPI(title="CRISH API", description="Sample API to fetch case reports and weather parameter forecasts from PostgreSQL", version="1.0")
+app = FastAPI(title="CRISH API", description="Sample API to fetch case reports and weather parameter forecasts from PostgreSQL", version="1.0", lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# The list endpoints produce highly repetitive JSON; gzip cuts the payload
+# 5-10x. Small responses are left uncompressed.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 # Define the case_reports table model
 class CaseReport(Base):
@@ -54,33 +145,64 @@ class CaseReport(Base):
     ageGroupUnknownCases = Column(Float)
     administrativeLevel = Column(BigInteger)
 
+    # Composite index covering the /case_reports filter columns
+    __table_args__ = (
+        Index("ix_case_reports_filters", "caseType", "reportingEntityType", "weekNumber"),
+    )
+
 # Database models for the tables
 class RainfallDailyWeightedAverage(Base):
     __tablename__ = "rainfall_daily_weighted_average"
-    forecast_date = Column(Text, primary_key=True)
+    forecast_date = Column(Date, primary_key=True)
     day_name = Column(Text)
     value = Column(Float)
     municipality_code = Column(Text, primary_key=True)
     municipality_name = Column(Text)
 
+    # Covers the weather_daily join key
+    __table_args__ = (
+        Index("ix_rainfall_join", "forecast_date", "day_name", "municipality_code"),
+    )
+
 class RelativeHumidityDailyAverage(Base):
     __tablename__ = "rh_daily_avg_region"
-    forecast_date = Column(Text, primary_key=True)
+    forecast_date = Column(Date, primary_key=True)
     day_name = Column(Text)
     value = Column(Float)
     municipality_code = Column(Text, primary_key=True)
     municipality_name = Column(Text)
 
+    # Covers the weather_daily join key
+    __table_args__ = (
+        Index("ix_rh_join", "forecast_date", "day_name", "municipality_code"),
+    )
+
 class TemperatureDailyMax(Base):
     __tablename__ = "tmax_daily_tmax_region"
-    forecast_date = Column(Text, primary_key=True)
+    forecast_date = Column(Date, primary_key=True)
     day_name = Column(Text)
     value = Column(Float)
     municipality_code = Column(Text, primary_key=True)
     municipality_name = Column(Text)
 
+    # Covers the weather_daily join key
+    __table_args__ = (
+        Index("ix_tmax_join", "forecast_date", "day_name", "municipality_code"),
+    )
+
+class WeatherDaily(ViewBase):
+    __tablename__ = "weather_daily"
+    forecast_date = Column(Date, primary_key=True)
+    day_name = Column(Text)
+    municipality_code = Column(Text, primary_key=True)
+    municipality_name = Column(Text)
+    relative_humidity = Column(Float)
+    temperature_max = Column(Float)
+    rainfall = Column(Float)
+    heat_index = Column(Float)
+
 class WeatherData(BaseModel):
-    forecast_date: str
+    forecast_date: date
     day_name: str
     municipality_name: str
     relative_humidity: float | None
@@ -110,60 +232,100 @@ class CaseReportModel(BaseModel):
     ageGroupUnknownCases: Optional[float]
     administrativeLevel: Optional[int]
 
-    class Config:
-        orm_mode = True
+    model_config = ConfigDict(from_attributes=True)
+
+class CaseReportPage(BaseModel):
+    items: List[CaseReportModel]
+    next_cursor: Optional[int]  # Pass as after_id to fetch the next page
+    total_records: Optional[int]  # Only populated when include_total=true
+
+class CaseReportBatchRequest(BaseModel):
+    ids: List[int]
+
+class WeatherBatchKey(BaseModel):
+    forecast_date: date
+    municipality_code: str
 
 # Dependency for DB session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
-
-# Initialize database
-@app.on_event("startup")
-def startup_event():
-    Base.metadata.create_all(bind=engine)
 
 @app.get(
     "/case_reports",
     summary="Fetch all case reports with filtering and paging",
     tags=["case_reports"],
-    response_model=List[CaseReportModel],  # Response will be a list of Pydantic models
+    response_model=CaseReportPage,  # Items plus the cursor for the next page
 )
-def get_case_reports(
-    db: Session = Depends(get_db),
+async def get_case_reports(
+    db: AsyncSession = Depends(get_db),
     caseType: str | None = Query(None, description="Filter by case type"),
     reportingEntityType: str | None = Query(None, description="Filter by reporting entity type"),
     weekNumber: int | None = Query(None, description="Filter by week number"),
-    page: int = Query(1, ge=1, description="Page number (starts at 1)"),
+    after_id: int | None = Query(None, description="Return reports with id greater than this cursor"),
     page_size: int = Query(10, ge=1, le=100, description="Number of items per page (max 100)"),
+    include_total: bool = Query(False, description="Also count the filtered set (extra query)"),
+    fields: str | None = Query(None, description="Comma-separated subset of columns to return"),
 ):
     """
     Fetch all case reports from the database with optional filters and paging.
+
+    Pages are keyset-based: each response carries a `next_cursor`, which the
+    client passes back as `after_id` to get the next page. This keeps every
+    page a single indexed range scan on `id` regardless of page depth.
+
+    `fields` narrows the SELECT to the named columns (`id` is always
+    included, as it anchors the cursor), cutting bytes over the wire.
     """
-    query = db.query(CaseReport)
+    # Select plain columns rather than hydrating full ORM entities
+    selected = list(CaseReportModel.model_fields)
+    if fields:
+        requested = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = [f for f in requested if f not in CaseReportModel.model_fields]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+        selected = ["id"] + [f for f in requested if f != "id"]
+
+    query = select(*(getattr(CaseReport, f) for f in selected))
 
     # Apply filters if provided
     if caseType:
-        query = query.filter(CaseReport.caseType == caseType)
+        query = query.where(CaseReport.caseType == caseType)
     if reportingEntityType:
-        query = query.filter(CaseReport.reportingEntityType == reportingEntityType)
+        query = query.where(CaseReport.reportingEntityType == reportingEntityType)
     if weekNumber:
-        query = query.filter(CaseReport.weekNumber == weekNumber)
+        query = query.where(CaseReport.weekNumber == weekNumber)
+
+    # The COUNT round-trip is opt-in; most clients only walk the cursor
+    total_records = None
+    if include_total:
+        total_records = await db.scalar(select(func.count()).select_from(query.subquery()))
 
-    # Calculate pagination
-    total_records = query.count()  # Total number of records after applying filters
-    offset = (page - 1) * page_size  # Calculate offset
-    query = query.offset(offset).limit(page_size)  # Apply limit and offset for paging
+    # Seek past the cursor instead of OFFSET-scanning discarded rows. Fetch
+    # one row beyond the page so next_cursor is only set when a next page
+    # actually exists (a bare len == page_size check would point the client
+    # at an empty page whenever the total is an exact multiple of page_size).
+    if after_id is not None:
+        query = query.where(CaseReport.id > after_id)
+    query = query.order_by(CaseReport.id).limit(page_size + 1)
 
-    case_reports = query.all()
+    case_reports = (await db.execute(query)).mappings().all()
 
-    if not case_reports:
+    if not case_reports and after_id is None:
         raise HTTPException(status_code=404, detail="No case reports found")
 
-    return case_reports  # orm_mode in Pydantic handles the serialization
+    has_more = len(case_reports) > page_size
+    case_reports = case_reports[:page_size]
+    next_cursor = case_reports[-1]["id"] if has_more else None
+    page = CaseReportPage(
+        # RowMapping dicts feed model_construct directly, no validation pass
+        items=[CaseReportModel.model_construct(**row) for row in case_reports],
+        next_cursor=next_cursor,
+        total_records=total_records,
+    )
+    # Serialize with orjson directly; response_model stays for the docs only.
+    # exclude_unset keeps projected items down to the requested fields.
+    return ORJSONResponse(page.model_dump(exclude_unset=True))
 
 @app.get(
     "/case_reports/{report_id}",
@@ -171,84 +333,168 @@ def get_case_reports(
     tags=["case_reports"],
     response_model=CaseReportModel,  # Use the Pydantic model for the response
 )
-def get_case_report(report_id: int, db: Session = Depends(get_db)):
+async def get_case_report(report_id: int, db: AsyncSession = Depends(get_db)):
     """
     Fetch a specific case report by its ID.
     """
-    report = db.query(CaseReport).filter(CaseReport.id == report_id).first()
+    # Plain column select: no ORM hydration or identity-map bookkeeping on
+    # this read-only path
+    query = select(*(getattr(CaseReport, f) for f in CaseReportModel.model_fields)).where(
+        CaseReport.id == report_id
+    )
+    report = (await db.execute(query)).mappings().first()
     if not report:
         raise HTTPException(status_code=404, detail="Case report not found")
-    return report  # Pydantic model with `orm_mode` will handle serialization
+    return ORJSONResponse(CaseReportModel.model_construct(**report).model_dump())
 
-# Heat index computation (basic formula)
-def compute_heat_index(temperature: float, humidity: float) -> float | None:
-    if temperature is None or humidity is None:
-        return None
+@app.post(
+    "/case_reports:batch",
+    summary="Fetch many case reports by ID in one round-trip",
+    tags=["case_reports"],
+    response_model=Dict[int, CaseReportModel],
+)
+async def get_case_reports_batch(request: CaseReportBatchRequest, db: AsyncSession = Depends(get_db)):
+    """
+    Fetch several case reports at once, keyed by id. Missing ids are simply
+    absent from the response. Collapses N GET round-trips into one.
+    """
+    if not request.ids:
+        raise HTTPException(status_code=400, detail="ids must not be empty")
+    if len(request.ids) > 1000:
+        raise HTTPException(status_code=400, detail="At most 1000 ids per batch")
 
-    # Example formula for heat index (simplified)
-    try:
-        heat_index = temperature + 0.5555 * (6.11 * math.exp((5417.7530 * (1 / 273.15 - 1 / (273.15 + temperature)))) - 10)
-        return heat_index
-    except Exception as e:
-        return None  # Return None in case of any computation errors
+    query = select(*(getattr(CaseReport, f) for f in CaseReportModel.model_fields)).where(
+        CaseReport.id.in_(request.ids)
+    )
+    rows = (await db.execute(query)).mappings().all()
+    return ORJSONResponse(
+        {row["id"]: CaseReportModel.model_construct(**row).model_dump() for row in rows}
+    )
 
 # Endpoint for fetching data
 @app.get("/weather", response_model=list[WeatherData], summary="Fetch weather data with computed heat indices", tags=["weather"])
-def fetch_weather_data(
-    forecast_date: str | None = Query(None, description="Filter by forecast date (YYYY-MM-DD)"),
+async def fetch_weather_data(
+    forecast_date: date | None = Query(None, description="Filter by forecast date (YYYY-MM-DD)"),
+    date_from: date | None = Query(None, description="Start of forecast date range (inclusive)"),
+    date_to: date | None = Query(None, description="End of forecast date range (inclusive, at most 31 days after date_from)"),
     municipality_code: str | None = Query(None, description="Filter by municipality code"),
     municipality_name: str | None = Query(None, description="Filter by municipality name"),
-    db: Session = Depends(get_db),
+    stream: bool = Query(False, description="Stream results as NDJSON instead of a JSON array"),
+    db: AsyncSession = Depends(get_db),
 ):
-    query = db.query(
-        RelativeHumidityDailyAverage.forecast_date.label("forecast_date"),
-        RelativeHumidityDailyAverage.day_name.label("day_name"),
-        RelativeHumidityDailyAverage.municipality_name.label("municipality_name"),
-        RelativeHumidityDailyAverage.value.label("relative_humidity"),
-        TemperatureDailyMax.value.label("temperature_max"),
-        RainfallDailyWeightedAverage.value.label("rainfall"),
-    ).join(
-        TemperatureDailyMax,
-        and_(
-            RelativeHumidityDailyAverage.forecast_date == TemperatureDailyMax.forecast_date,
-            RelativeHumidityDailyAverage.day_name == TemperatureDailyMax.day_name,
-            RelativeHumidityDailyAverage.municipality_code == TemperatureDailyMax.municipality_code,
-        ),
-        isouter=True,
-    ).join(
-        RainfallDailyWeightedAverage,
-        and_(
-            RelativeHumidityDailyAverage.forecast_date == RainfallDailyWeightedAverage.forecast_date,
-            RelativeHumidityDailyAverage.day_name == RainfallDailyWeightedAverage.day_name,
-            RelativeHumidityDailyAverage.municipality_code == RainfallDailyWeightedAverage.municipality_code,
-        ),
-        isouter=True,
-    )
+    # Every request must be bounded in time so no query can scan the whole
+    # multi-year view
+    if forecast_date is None:
+        if date_from is None or date_to is None:
+            raise HTTPException(status_code=400, detail="Provide forecast_date, or both date_from and date_to")
+        if date_to < date_from:
+            raise HTTPException(status_code=400, detail="date_to must not be before date_from")
+        if (date_to - date_from).days > 31:
+            raise HTTPException(status_code=400, detail="Date range must be at most 31 days")
+
+    cache_key = f"weather:{forecast_date}:{date_from}:{date_to}:{municipality_code}:{municipality_name}"
+    if redis_client is not None and not stream:
+        cached = await redis_client.get(cache_key)
+        if cached is not None:
+            cache_stats["hit"] += 1
+            return Response(content=cached, media_type="application/json")
+        cache_stats["miss"] += 1
+
+    # lambda_stmt caches the compiled form per statement shape, so repeat
+    # requests skip expression-tree construction and SQL compilation
+    query = lambda_stmt(lambda: select(
+        WeatherDaily.forecast_date,
+        WeatherDaily.day_name,
+        WeatherDaily.municipality_name,
+        WeatherDaily.relative_humidity,
+        WeatherDaily.temperature_max,
+        WeatherDaily.rainfall,
+        WeatherDaily.heat_index,
+    ))
 
     if forecast_date:
-        query = query.filter(RelativeHumidityDailyAverage.forecast_date == forecast_date)
+        query += lambda s: s.where(WeatherDaily.forecast_date == forecast_date)
+    else:
+        query += lambda s: s.where(WeatherDaily.forecast_date.between(date_from, date_to))
     if municipality_code:
-        query = query.filter(RelativeHumidityDailyAverage.municipality_code == municipality_code)
+        query += lambda s: s.where(WeatherDaily.municipality_code == municipality_code)
     if municipality_name:
-        query = query.filter(RelativeHumidityDailyAverage.municipality_name == municipality_name)
+        query += lambda s: s.where(WeatherDaily.municipality_name == municipality_name)
+    # Belt-and-braces cap on top of the 31-day window
+    query += lambda s: s.limit(10_000)
 
-    results = query.all()
+    if stream:
+        # Server-side cursor: rows are fetched in batches of 500 and written
+        # out as they arrive, so peak memory stays flat for large result sets.
+        # The Depends(get_db) session is torn down before the response body is
+        # iterated, so the generator opens its own session, whose lifetime
+        # spans the whole stream.
+        async def ndjson_rows():
+            async with SessionLocal() as stream_db:
+                result = await stream_db.stream(query, execution_options={"yield_per": 500})
+                async for row in result:
+                    yield orjson.dumps(dict(row._mapping)) + b"\n"
+
+        return StreamingResponse(ndjson_rows(), media_type="application/x-ndjson")
+
+    results = (await db.execute(query)).all()
     if not results:
         raise HTTPException(status_code=404, detail="No data found for the given filters")
 
-    weather_data = []
-    for row in results:
-        row_dict = row._mapping
-        heat_index = compute_heat_index(row_dict["temperature_max"], row_dict["relative_humidity"])
-        print(heat_index)
-        weather_data.append(WeatherData(
-            forecast_date=row_dict["forecast_date"],
-            day_name=row_dict["day_name"],
-            municipality_name=row_dict["municipality_name"],
-            relative_humidity=row_dict["relative_humidity"],
-            temperature_max=row_dict["temperature_max"],
-            rainfall=row_dict["rainfall"],
-            heat_index=heat_index,
-        ))
-
-    return weather_data
\ No newline at end of file
+    # Rows come straight from our own view, so skip per-row validation
+    weather_data = [WeatherData.model_construct(**row._mapping) for row in results]
+
+    # Serialize once with orjson; the same bytes go to the cache and the client
+    payload = orjson.dumps([w.model_dump() for w in weather_data])
+    if redis_client is not None:
+        await redis_client.set(cache_key, payload, ex=WEATHER_CACHE_TTL)
+
+    return Response(content=payload, media_type="application/json")
+
+@app.post("/weather:batch", response_model=list[WeatherData], summary="Fetch weather data for many (date, municipality) keys at once", tags=["weather"])
+async def fetch_weather_data_batch(keys: List[WeatherBatchKey], db: AsyncSession = Depends(get_db)):
+    """
+    Fetch weather rows for a list of (forecast_date, municipality_code) keys
+    in a single round-trip, instead of one /weather call per municipality.
+    """
+    if not keys:
+        raise HTTPException(status_code=400, detail="keys must not be empty")
+    if len(keys) > 1000:
+        raise HTTPException(status_code=400, detail="At most 1000 keys per batch")
+
+    query = select(
+        WeatherDaily.forecast_date,
+        WeatherDaily.day_name,
+        WeatherDaily.municipality_name,
+        WeatherDaily.relative_humidity,
+        WeatherDaily.temperature_max,
+        WeatherDaily.rainfall,
+        WeatherDaily.heat_index,
+    ).where(
+        tuple_(WeatherDaily.forecast_date, WeatherDaily.municipality_code).in_(
+            [(k.forecast_date, k.municipality_code) for k in keys]
+        )
+    )
+    results = (await db.execute(query)).all()
+    payload = orjson.dumps([WeatherData.model_construct(**row._mapping).model_dump() for row in results])
+    return Response(content=payload, media_type="application/json")
+
+@app.post("/weather/refresh", summary="Refresh the weather_daily materialized view", tags=["weather"], status_code=204)
+async def refresh_weather_daily():
+    """
+    Re-materialize weather_daily from the upstream forecast tables. Intended
+    to be called (e.g. by cron) after the upstream ETL loads finish.
+    """
+    # CONCURRENTLY cannot run inside a transaction block
+    async with engine.connect() as conn:
+        autocommit = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        await autocommit.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY weather_daily"))
+    await invalidate_weather_cache()
+
+@app.get("/weather/cache_stats", summary="Hit/miss counts for the /weather Redis cache", tags=["weather"])
+async def get_weather_cache_stats():
+    """
+    Report how the /weather cache is doing since this worker started. Counts
+    are per-process; "enabled" is false when REDIS_URL is not set.
+    """
+    return {"enabled": redis_client is not None, **cache_stats}
\ No newline at end of file
@@ -0,0 +1,40 @@
+-- One-time migration for existing databases: narrow the forecast_date join
+-- key on the three weather tables from text to date. create_all only creates
+-- missing tables, so run this manually (psql -f) against deployed databases;
+-- fresh databases get the date column directly from the model definitions.
+--
+-- The weather_daily materialized view depends on these columns, so it is
+-- dropped before the ALTERs and recreated (with the new column types)
+-- afterwards. Keep the view definition in sync with WEATHER_DAILY_DDL in
+-- main.py.
+
+BEGIN;
+
+DROP MATERIALIZED VIEW IF EXISTS weather_daily;
+
+ALTER TABLE rh_daily_avg_region
+    ALTER COLUMN forecast_date TYPE date USING forecast_date::date;
+ALTER TABLE tmax_daily_tmax_region
+    ALTER COLUMN forecast_date TYPE date USING forecast_date::date;
+ALTER TABLE rainfall_daily_weighted_average
+    ALTER COLUMN forecast_date TYPE date USING forecast_date::date;
+
+CREATE MATERIALIZED VIEW weather_daily AS
+SELECT rh.forecast_date,
+       rh.day_name,
+       rh.municipality_code,
+       rh.municipality_name,
+       rh.value AS relative_humidity,
+       t.value AS temperature_max,
+       r.value AS rainfall,
+       CASE WHEN rh.value IS NOT NULL AND t.value BETWEEN -50 AND 80
+            THEN t.value + 0.5555 * (6.11 * exp(5417.7530 * (1/273.15 - 1/(273.15 + t.value))) - 10)
+       END AS heat_index
+FROM rh_daily_avg_region rh
+LEFT JOIN tmax_daily_tmax_region t USING (forecast_date, day_name, municipality_code)
+LEFT JOIN rainfall_daily_weighted_average r USING (forecast_date, day_name, municipality_code);
+
+CREATE UNIQUE INDEX ix_weather_daily_date_code ON weather_daily (forecast_date, municipality_code);
+CREATE INDEX ix_weather_daily_municipality_name ON weather_daily (municipality_name);
+
+COMMIT;
@@ -0,0 +1,14 @@
+-- Indexes for the /case_reports filter columns and the weather join keys.
+-- Fresh dev databases get these from the __table_args__ declarations via
+-- create_all, but create_all skips tables that already exist, so deployed
+-- databases must create them here. All statements are idempotent.
+
+CREATE INDEX IF NOT EXISTS ix_case_reports_filters
+    ON case_reports ("caseType", "reportingEntityType", "weekNumber");
+
+CREATE INDEX IF NOT EXISTS ix_rh_join
+    ON rh_daily_avg_region (forecast_date, day_name, municipality_code);
+CREATE INDEX IF NOT EXISTS ix_tmax_join
+    ON tmax_daily_tmax_region (forecast_date, day_name, municipality_code);
+CREATE INDEX IF NOT EXISTS ix_rainfall_join
+    ON rainfall_daily_weighted_average (forecast_date, day_name, municipality_code);